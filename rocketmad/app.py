@@ -140,9 +140,15 @@ def create_app():
         args.db_user, args.db_pass, args.db_host, args.db_port, args.db_name)
     app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
     app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-        'pool_size': 0  # No limit.
+        'pool_size': 0,  # No limit.
+        'pool_recycle': args.db_pool_recycle,
+        # Check connections on checkout so ones dropped by the server are
+        # replaced instead of failing the request.
+        'pool_pre_ping': True,
+        # Reuse the most recently returned connection so a few warm ones
+        # serve most requests and the rest can time out server-side.
+        'pool_use_lifo': True
     }
-    app.config['SQLALCHEMY_POOL_RECYCLE'] = args.db_pool_recycle
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     db.init_app(app)
 
@@ -705,7 +711,8 @@ def create_app():
         d = {}
 
         # Request time of this request.
-        d['timestamp'] = datetime.utcnow()
+        now = datetime.utcnow()
+        d['timestamp'] = now
 
         # Request time of previous request.
         if request.args.get('timestamp'):
@@ -818,7 +825,7 @@ def create_app():
                         swLat, swLng, neLat, neLng, eids=eids, ids=ids,
                         geofences=geofences,
                         exclude_geofences=exclude_geofences,
-                        verified_despawn_time=verified_despawn))
+                        verified_despawn_time=verified_despawn, now=now))
             else:
                 # If map is already populated only request modified Pokemon
                 # since last request time.
@@ -827,7 +834,7 @@ def create_app():
                         swLat, swLng, neLat, neLng, timestamp=timestamp,
                         eids=eids, ids=ids, geofences=geofences,
                         exclude_geofences=exclude_geofences,
-                        verified_despawn_time=verified_despawn))
+                        verified_despawn_time=verified_despawn, now=now))
 
                 if new_area:
                     # If screen is moved add newly uncovered Pokemon to the
@@ -839,7 +846,8 @@ def create_app():
                                 oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng,
                                 eids=eids, ids=ids, geofences=geofences,
                                 exclude_geofences=exclude_geofences,
-                                verified_despawn_time=verified_despawn)))
+                                verified_despawn_time=verified_despawn,
+                                now=now)))
 
             if request.args.get('reids'):
                 request_reids = request.args.get('reids').split(',')
@@ -848,7 +856,8 @@ def create_app():
                     Pokemon.get_active(swLat, swLng, neLat, neLng, ids=reids,
                                        geofences=geofences,
                                        exclude_geofences=exclude_geofences,
-                                       verified_despawn_time=verified_despawn))
+                                       verified_despawn_time=verified_despawn,
+                                       now=now))
                 d['reids'] = reids
 
         if seen:
@@ -878,19 +887,22 @@ def create_app():
             if timestamp == 0 or all_gyms:
                 d['gyms'] = Gym.get_gyms(swLat, swLng, neLat, neLng,
                                          raids=raids, geofences=geofences,
-                                         exclude_geofences=exclude_geofences)
+                                         exclude_geofences=exclude_geofences,
+                                         now=now)
             else:
                 d['gyms'] = Gym.get_gyms(swLat, swLng, neLat, neLng,
                                          timestamp=timestamp, raids=raids,
                                          geofences=geofences,
-                                         exclude_geofences=exclude_geofences)
+                                         exclude_geofences=exclude_geofences,
+                                         now=now)
                 if new_area:
                     d['gyms'].extend(
                         Gym.get_gyms(swLat, swLng, neLat, neLng,
                                      oSwLat=oSwLat, oSwLng=oSwLng,
                                      oNeLat=oNeLat, oNeLng=oNeLng,
                                      raids=raids, geofences=geofences,
-                                     exclude_geofences=exclude_geofences))
+                                     exclude_geofences=exclude_geofences,
+                                     now=now))
 
         if pokestops and (eventless_pokestops or quests or invasions or lures):
             if timestamp == 0 or all_pokestops:
@@ -898,14 +910,14 @@ def create_app():
                     swLat, swLng, neLat, neLng,
                     eventless_stops=eventless_pokestops, quests=quests,
                     invasions=invasions, lures=lures, geofences=geofences,
-                    exclude_geofences=exclude_geofences
+                    exclude_geofences=exclude_geofences, now=now
                 )
             else:
                 d['pokestops'] = Pokestop.get_pokestops(
                     swLat, swLng, neLat, neLng, timestamp=timestamp,
                     eventless_stops=eventless_pokestops, quests=quests,
                     invasions=invasions, lures=lures, geofences=geofences,
-                    exclude_geofences=exclude_geofences
+                    exclude_geofences=exclude_geofences, now=now
                 )
                 if new_area:
                     d['pokestops'].extend(Pokestop.get_pokestops(
@@ -913,7 +925,7 @@ def create_app():
                         oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng,
                         eventless_stops=eventless_pokestops, quests=quests,
                         invasions=invasions, lures=lures, geofences=geofences,
-                        exclude_geofences=exclude_geofences
+                        exclude_geofences=exclude_geofences, now=now
                     ))
 
         if weather:
@@ -960,20 +972,20 @@ def create_app():
             if timestamp == 0 or all_scanned_locs:
                 d['scannedlocs'] = ScannedLocation.get_recent(
                     swLat, swLng, neLat, neLng, geofences=geofences,
-                    exclude_geofences=exclude_geofences
+                    exclude_geofences=exclude_geofences, now=now
                 )
             else:
                 d['scannedlocs'] = ScannedLocation.get_recent(
                     swLat, swLng, neLat, neLng, timestamp=timestamp,
                     geofences=geofences,
-                    exclude_geofences=exclude_geofences
+                    exclude_geofences=exclude_geofences, now=now
                 )
                 if new_area:
                     d['scannedlocs'] += ScannedLocation.get_recent(
                         swLat, swLng, neLat, neLng, oSwLat=oSwLat,
                         oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng,
                         geofences=geofences,
-                        exclude_geofences=exclude_geofences
+                        exclude_geofences=exclude_geofences, now=now
                     )
 
         if nests:
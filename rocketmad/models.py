@@ -2,24 +2,30 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import numpy as np
+import sched
 import sys
 import time
 
 from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func, Index, text
+from operator import attrgetter
+from sqlalchemy import (bindparam, Boolean, case, func, Index, inspect, select,
+                        text, update)
 from sqlalchemy.dialects.mysql import BIGINT, DOUBLE, LONGTEXT, TINYINT
-from sqlalchemy.orm import Load, load_only
 from sqlalchemy.sql.expression import and_, or_
 from timeit import default_timer
 
-from .utils import get_args
+from .utils import get_args, minsec_to_seconds
 
 log = logging.getLogger(__name__)
 args = get_args()
 
 db = SQLAlchemy()
-db_schema_version = 1
+db_schema_version = 4
+
+ONE_HOUR = np.timedelta64(1, 'h')
+HALF_HOUR = np.timedelta64(30, 'm')
 
 
 class Pokemon(db.Model):
@@ -60,77 +66,49 @@ class Pokemon(db.Model):
         Index('pokemon_latitude_longitude', 'latitude', 'longitude'),
         Index('pokemon_disappear_time_pokemon_id', 'disappear_time',
               'pokemon_id'),
+        # Lets active viewport queries range scan disappear_time and filter
+        # the bounds from the index.
+        Index('pokemon_disappear_time_latitude_longitude', 'disappear_time',
+              'latitude', 'longitude'),
     )
 
     @staticmethod
     def get_active(swLat, swLng, neLat, neLng, oSwLat=None, oSwLng=None,
                    oNeLat=None, oNeLng=None, timestamp=0, eids=None, ids=None,
                    geofences=None, exclude_geofences=None,
-                   verified_despawn_time=False):
-        columns = [
-            Pokemon.encounter_id, Pokemon.pokemon_id, Pokemon.latitude,
-            Pokemon.longitude, Pokemon.disappear_time,
-            Pokemon.individual_attack, Pokemon.individual_defense,
-            Pokemon.individual_stamina, Pokemon.move_1, Pokemon.move_2,
-            Pokemon.cp, Pokemon.cp_multiplier, Pokemon.weight, Pokemon.height,
-            Pokemon.gender, Pokemon.form, Pokemon.costume,
-            Pokemon.catch_prob_1, Pokemon.catch_prob_2, Pokemon.catch_prob_3,
-            Pokemon.weather_boosted_condition, Pokemon.last_modified
-        ]
-
+                   verified_despawn_time=False, now=None):
         if verified_despawn_time:
-            columns.append(
-                TrsSpawn.calc_endminsec.label('verified_disappear_time')
-            )
-            query = (
-                db.session.query(*columns)
-                .outerjoin(
-                    TrsSpawn, Pokemon.spawnpoint_id == TrsSpawn.spawnpoint
-                )
-            )
+            stmt = active_pokemon_verified_stmt
         else:
-            query = db.session.query(*columns)
-
-        query = query.filter(Pokemon.disappear_time > datetime.utcnow())
-
-        if timestamp > 0:
-            # If timestamp is known only load modified Pokémon.
-            t = datetime.utcfromtimestamp(timestamp / 1000)
-            query = query.filter(Pokemon.last_modified > t)
-
-        if swLat and swLng and neLat and neLng:
-            query = query.filter(
-                Pokemon.latitude >= swLat,
-                Pokemon.longitude >= swLng,
-                Pokemon.latitude <= neLat,
-                Pokemon.longitude <= neLng
-            )
-
-        if oSwLat and oSwLng and oNeLat and oNeLng:
-            # Exclude Pokémon within old boundaries.
-            query = query.filter(
-                ~and_(
-                    Pokemon.latitude >= oSwLat,
-                    Pokemon.longitude >= oSwLng,
-                    Pokemon.latitude <= oNeLat,
-                    Pokemon.longitude <= oNeLng
-                )
-            )
+            stmt = active_pokemon_stmt
 
         if geofences:
             sql = geofences_to_query(geofences, 'pokemon')
-            query = query.filter(text(sql))
+            stmt = stmt.where(text(sql))
 
         if exclude_geofences:
             sql = geofences_to_query(exclude_geofences, 'pokemon')
-            query = query.filter(~text(sql))
+            stmt = stmt.where(~text(sql))
 
         if eids:
-            query = query.filter(Pokemon.pokemon_id.notin_(eids))
+            stmt = stmt.where(Pokemon.pokemon_id.notin_(eids))
         elif ids:
-            query = query.filter(Pokemon.pokemon_id.in_(ids))
+            stmt = stmt.where(Pokemon.pokemon_id.in_(ids))
 
-        return [pokemon._asdict() for pokemon in query.all()]
+        params = viewport_params(swLat, swLng, neLat, neLng, oSwLat, oSwLng,
+                                 oNeLat, oNeLng)
+        # Callers running several queries per request can share one 'now'.
+        params['now'] = now or datetime.utcnow()
+        if timestamp > 0:
+            # If timestamp is known only load modified Pokémon.
+            params['timestamp'] = datetime.utcfromtimestamp(timestamp / 1000)
+        # Read-only, so skip the ORM layer and execute on the connection.
+        result = db.session.connection().execute(stmt, params)
+
+        # Zip plain row tuples with the column names once per row rather
+        # than going through a RowMapping for each of the ~20 columns.
+        keys = tuple(result.keys())
+        return [dict(zip(keys, pokemon)) for pokemon in result]
 
     # Get all Pokémon spawn counts based on the last x hours.
     # More efficient than get_seen(): we don't do any unnecessary mojo.
@@ -150,13 +128,11 @@ class Pokemon(db.Model):
             hours = datetime.utcnow() - timedelta(hours=hours)
             query = query.filter(Pokemon.disappear_time > hours)
 
-        result = query.all()
+        conn = db.session.connection()
+        result = conn.execute(query.statement).mappings().all()
 
-        counts = []
-        total = 0
-        for c in result:
-            counts.append(c._asdict())
-            total += c[1]
+        counts = [dict(c) for c in result]
+        total = sum(c['count'] for c in counts)
 
         return {'pokemon': counts, 'total': total}
 
@@ -183,13 +159,11 @@ class Pokemon(db.Model):
             sql = geofences_to_query(exclude_geofences, 'pokemon')
             query = query.filter(~text(sql))
 
-        result = query.all()
+        conn = db.session.connection()
+        result = conn.execute(query.statement).mappings().all()
 
-        pokemon = []
-        total = 0
-        for p in result:
-            pokemon.append(p._asdict())
-            total += p[2]
+        pokemon = [dict(p) for p in result]
+        total = sum(p['count'] for p in pokemon)
 
         return {'pokemon': pokemon, 'total': total}
 
@@ -230,9 +204,9 @@ class Pokemon(db.Model):
             sql = geofences_to_query(exclude_geofences, 'pokemon')
             query = query.filter(~text(sql))
 
-        result = query.all()
+        result = db.session.connection().execute(query.statement).mappings()
 
-        return [a._asdict() for a in result]
+        return [dict(a) for a in result]
 
     @staticmethod
     def get_appearances_times_by_spawnpoint(pokemon_id, spawnpoint_id,
@@ -298,8 +272,10 @@ class Gym(db.Model):
     )
     is_ex_raid_eligible = db.Column(TINYINT, default=0, nullable=False)
 
+    # get_gyms() joins the two GymDetails columns it needs itself, so don't
+    # join the whole row into every other Gym query.
     gym_details = db.relationship(
-        'GymDetails', uselist=False, backref='gym', lazy='joined',
+        'GymDetails', uselist=False, backref='gym', lazy='select',
         cascade='delete')
 
     __table_args__ = (
@@ -311,72 +287,34 @@ class Gym(db.Model):
     @staticmethod
     def get_gyms(swLat, swLng, neLat, neLng, oSwLat=None, oSwLng=None,
                  oNeLat=None, oNeLng=None, timestamp=0, raids=True,
-                 geofences=None, exclude_geofences=None):
-        if raids:
-            query = (
-                db.session.query(Gym, Raid)
-                .outerjoin(
-                    Raid,
-                    and_(
-                        Gym.gym_id == Raid.gym_id,
-                        Raid.end > datetime.utcnow()
-                    )
-                )
-            )
-        else:
-            query = Gym.query
-
-        if timestamp > 0:
-            # If timestamp is known only send last scanned Gyms.
-            t = datetime.utcfromtimestamp(timestamp / 1000)
-            query = query.filter(Gym.last_scanned > t)
-
-        if swLat and swLng and neLat and neLng:
-            query = query.filter(
-                Gym.latitude >= swLat,
-                Gym.longitude >= swLng,
-                Gym.latitude <= neLat,
-                Gym.longitude <= neLng
-            )
-
-        if oSwLat and oSwLng and oNeLat and oNeLng:
-            # Exclude Gyms within old boundaries.
-            query = query.filter(
-                ~and_(
-                    Gym.latitude >= oSwLat,
-                    Gym.longitude >= oSwLng,
-                    Gym.latitude <= oNeLat,
-                    Gym.longitude <= oNeLng
-                )
-            )
+                 geofences=None, exclude_geofences=None, now=None):
+        stmt = gym_raid_stmt if raids else gym_stmt
 
         if geofences:
             sql = geofences_to_query(geofences, 'gym')
-            query = query.filter(text(sql))
+            stmt = stmt.where(text(sql))
 
         if exclude_geofences:
             sql = geofences_to_query(exclude_geofences, 'gym')
-            query = query.filter(~text(sql))
+            stmt = stmt.where(~text(sql))
 
-        result = query.all()
+        params = viewport_params(swLat, swLng, neLat, neLng, oSwLat, oSwLng,
+                                 oNeLat, oNeLng)
+        # Callers running several queries per request can share one 'now'.
+        params['now'] = now or datetime.utcnow()
+        if timestamp > 0:
+            # If timestamp is known only send last scanned Gyms.
+            params['timestamp'] = datetime.utcfromtimestamp(timestamp / 1000)
+        result = db.session.connection().execute(stmt, params)
 
         gyms = []
         for r in result:
-            gym = r[0] if raids else r
-            raid = r[1] if raids else None
-            gym_dict = orm_to_dict(gym)
-            del gym_dict['gym_details']
-            if gym.gym_details:
-                gym_dict['name'] = gym.gym_details.name
-                gym_dict['url'] = gym.gym_details.url
-            else:
-                gym_dict['name'] = None
-                gym_dict['url'] = None
-            if raid is not None:
-                gym_dict['raid'] = orm_to_dict(raid)
+            gym = pack_gym(r)
+            if raids and r.raid_gym_id is not None:
+                gym['raid'] = pack_raid(r)
             else:
-                gym_dict['raid'] = None
-            gyms.append(gym_dict)
+                gym['raid'] = None
+            gyms.append(gym)
 
         return gyms
 
@@ -458,116 +396,49 @@ class Pokestop(db.Model):
     def get_pokestops(swLat, swLng, neLat, neLng, oSwLat=None, oSwLng=None,
                       oNeLat=None, oNeLng=None, timestamp=0,
                       eventless_stops=True, quests=True, invasions=True,
-                      lures=True, geofences=None, exclude_geofences=None):
-        columns = [
-            'pokestop_id', 'name', 'image', 'latitude', 'longitude',
-            'last_updated', 'incident_grunt_type', 'incident_expiration',
-            'active_fort_modifier', 'lure_expiration'
-        ]
+                      lures=True, geofences=None, exclude_geofences=None,
+                      now=None):
+        params = viewport_params(swLat, swLng, neLat, neLng, oSwLat, oSwLng,
+                                 oNeLat, oNeLng)
 
         if quests:
-            quest_columns = [
-                'GUID', 'quest_timestamp', 'quest_task', 'quest_type',
-                'quest_stardust', 'quest_pokemon_id', 'quest_pokemon_form_id',
-                'quest_pokemon_costume_id', 'quest_reward_type',
-                'quest_item_id', 'quest_item_amount'
-            ]
             hours = int(args.quest_reset_time.split(':')[0])
             minutes = int(args.quest_reset_time.split(':')[1])
             reset_time = datetime.today().replace(
                 hour=hours, minute=minutes, second=0, microsecond=0
             )
-            reset_timestamp = datetime.timestamp(reset_time)
-            query = (
-                db.session.query(Pokestop, TrsQuest)
-                .outerjoin(
-                    TrsQuest,
-                    and_(
-                        Pokestop.pokestop_id == TrsQuest.GUID,
-                        TrsQuest.quest_timestamp >= reset_timestamp
-                    )
-                )
-                .options(
-                    Load(Pokestop).load_only(*columns),
-                    Load(TrsQuest).load_only(*quest_columns)
-                )
-            )
+            params['quest_reset_timestamp'] = datetime.timestamp(reset_time)
+            stmt = pokestop_quest_stmt
         else:
-            query = Pokestop.query.options(load_only(*columns))
-
-        if not eventless_stops:
-            conds = []
-            if quests:
-                conds.append(TrsQuest.GUID.isnot(None))
-            if invasions:
-                conds.append(Pokestop.incident_expiration > datetime.utcnow())
-            if lures:
-                conds.append(Pokestop.lure_expiration > datetime.utcnow())
-            query = query.filter(or_(*conds))
-
-        if timestamp > 0:
-            # If timestamp is known only send last scanned PokéStops.
-            t = datetime.utcfromtimestamp(timestamp / 1000)
-            query = query.filter(Pokestop.last_updated > t)
-
-        if swLat and swLng and neLat and neLng:
-            query = query.filter(
-                Pokestop.latitude >= swLat,
-                Pokestop.longitude >= swLng,
-                Pokestop.latitude <= neLat,
-                Pokestop.longitude <= neLng
-            )
-
-        if oSwLat and oSwLng and oNeLat and oNeLng:
-            # Exclude PokéStops within old boundaries.
-            query = query.filter(
-                ~and_(
-                    Pokestop.latitude >= oSwLat,
-                    Pokestop.longitude >= oSwLng,
-                    Pokestop.latitude <= oNeLat,
-                    Pokestop.longitude <= oNeLng
-                )
-            )
+            stmt = pokestop_stmt
 
         if geofences:
             sql = geofences_to_query(geofences, 'pokestop')
-            query = query.filter(text(sql))
+            stmt = stmt.where(text(sql))
 
         if exclude_geofences:
             sql = geofences_to_query(exclude_geofences, 'pokestop')
-            query = query.filter(~text(sql))
+            stmt = stmt.where(~text(sql))
 
-        result = query.all()
+        # Callers running several queries per request can share one 'now'.
+        params['now'] = now or datetime.utcnow()
+        params['eventless_stops'] = eventless_stops
+        params['invasions'] = invasions
+        params['lures'] = lures
+        if timestamp > 0:
+            # If timestamp is known only send last scanned PokéStops.
+            params['timestamp'] = datetime.utcfromtimestamp(timestamp / 1000)
+        result = db.session.connection().execute(stmt, params)
 
-        now = datetime.utcnow()
         pokestops = []
         for r in result:
-            pokestop_orm = r[0] if quests else r
-            quest_orm = r[1] if quests else None
-            pokestop = orm_to_dict(pokestop_orm)
-            if quest_orm is not None:
-                pokestop['quest'] = {
-                    'scanned_at': quest_orm.quest_timestamp * 1000,
-                    'task': quest_orm.quest_task,
-                    'reward_type': quest_orm.quest_reward_type,
-                    'item_id': quest_orm.quest_item_id,
-                    'item_amount': quest_orm.quest_item_amount,
-                    'pokemon_id': quest_orm.quest_pokemon_id,
-                    'form_id': quest_orm.quest_pokemon_form_id,
-                    'costume_id': quest_orm.quest_pokemon_costume_id,
-                    'stardust': quest_orm.quest_stardust
-                }
+            pokestop = pack_pokestop(r)
+            if quests and r.GUID is not None:
+                quest = pack_quest(r)
+                quest['scanned_at'] *= 1000
+                pokestop['quest'] = quest
             else:
                 pokestop['quest'] = None
-            if (pokestop['incident_expiration'] is not None
-                    and (pokestop['incident_expiration'] < now
-                         or not invasions)):
-                pokestop['incident_grunt_type'] = None
-                pokestop['incident_expiration'] = None
-            if (pokestop['lure_expiration'] is not None
-                    and (pokestop['lure_expiration'] < now or not lures)):
-                pokestop['active_fort_modifier'] = None
-                pokestop['lure_expiration'] = None
             pokestops.append(pokestop)
 
         return pokestops
@@ -644,47 +515,34 @@ class Weather(db.Model):
         lat_delta = 0.15
         lng_delta = 0.4
 
-        query = db.session.query(
-            Weather.s2_cell_id, Weather.latitude, Weather.longitude,
-            Weather.gameplay_weather, Weather.severity, Weather.world_time,
-            Weather.last_updated
-        )
-
-        if timestamp > 0:
-            # If timestamp is known only send last scanned weather.
-            t = datetime.utcfromtimestamp(timestamp / 1000)
-            query = query.filter(Weather.last_updated > t)
-
-        if swLat and swLng and neLat and neLng:
-            query = query.filter(
-                Weather.latitude >= float(swLat) - lat_delta,
-                Weather.longitude >= float(swLng) - lng_delta,
-                Weather.latitude <= float(neLat) + lat_delta,
-                Weather.longitude <= float(neLng) + lng_delta
-            )
-
-        if oSwLat and oSwLng and oNeLat and oNeLng:
-            # Exclude weather within old boundaries.
-            query = query.filter(
-                ~and_(
-                    Weather.latitude >= float(oSwLat) - lat_delta,
-                    Weather.longitude >= float(oSwLng) - lng_delta,
-                    Weather.latitude <= float(oNeLat) + lat_delta,
-                    Weather.longitude <= float(oNeLng) + lng_delta
-                )
-            )
+        stmt = weather_stmt
 
         if geofences:
             sql = geofences_to_query(geofences, 'weather')
-            query = query.filter(text(sql))
+            stmt = stmt.where(text(sql))
 
         if exclude_geofences:
             sql = geofences_to_query(exclude_geofences, 'weather')
-            query = query.filter(~text(sql))
-
-        result = query.all()
+            stmt = stmt.where(~text(sql))
+
+        params = viewport_params(swLat, swLng, neLat, neLng, oSwLat, oSwLng,
+                                 oNeLat, oNeLng)
+        if params['swLat'] is not None:
+            params['swLat'] = float(swLat) - lat_delta
+            params['swLng'] = float(swLng) - lng_delta
+            params['neLat'] = float(neLat) + lat_delta
+            params['neLng'] = float(neLng) + lng_delta
+        if params['oSwLat'] is not None:
+            params['oSwLat'] = float(oSwLat) - lat_delta
+            params['oSwLng'] = float(oSwLng) - lng_delta
+            params['oNeLat'] = float(oNeLat) + lat_delta
+            params['oNeLng'] = float(oNeLng) + lng_delta
+        if timestamp > 0:
+            # If timestamp is known only send last scanned weather.
+            params['timestamp'] = datetime.utcfromtimestamp(timestamp / 1000)
+        result = db.session.connection().execute(stmt, params).mappings()
 
-        return [w._asdict() for w in result]
+        return [dict(w) for w in result]
 
 
 class TrsSpawn(db.Model):
@@ -705,80 +563,75 @@ class TrsSpawn(db.Model):
 
     __table_args__ = (
         Index('event_lat_long', 'eventid', 'latitude', 'longitude'),
+        # Lets db_clean_spawnpoints() delete by a range scan. NULLs sort
+        # first, so 'IS NULL OR < timeout' is one range.
+        Index('trs_spawn_last_scanned_last_non_scanned', 'last_scanned',
+              'last_non_scanned'),
     )
 
     @staticmethod
     def get_spawnpoints(swLat, swLng, neLat, neLng, oSwLat=None, oSwLng=None,
                         oNeLat=None, oNeLng=None, timestamp=0, geofences=None,
                         exclude_geofences=None):
-        query = db.session.query(
-            TrsSpawn.latitude, TrsSpawn.longitude,
-            TrsSpawn.spawnpoint.label('spawnpoint_id'), TrsSpawn.spawndef,
-            TrsSpawn.first_detection, TrsSpawn.last_non_scanned,
-            TrsSpawn.last_scanned, TrsSpawn.calc_endminsec.label('end_time')
-        )
-
-        if timestamp > 0:
-            # If timestamp is known only send last scanned spawn points.
-            t = datetime.fromtimestamp(timestamp / 1000)
-            query = query.filter(
-                (TrsSpawn.last_scanned > t) | (TrsSpawn.last_non_scanned > t)
-            )
-
-        if swLat and swLng and neLat and neLng:
-            query = query.filter(
-                TrsSpawn.latitude >= swLat,
-                TrsSpawn.longitude >= swLng,
-                TrsSpawn.latitude <= neLat,
-                TrsSpawn.longitude <= neLng
-            )
-
-        if oSwLat and oSwLng and oNeLat and oNeLng:
-            # Exclude spawn points within old boundaries.
-            query = query.filter(
-                ~and_(
-                    TrsSpawn.latitude >= oSwLat,
-                    TrsSpawn.longitude >= oSwLng,
-                    TrsSpawn.latitude <= oNeLat,
-                    TrsSpawn.longitude <= oNeLng
-                )
-            )
+        stmt = spawnpoint_stmt
 
         if geofences:
             sql = geofences_to_query(geofences, 'trs_spawn')
-            query = query.filter(text(sql))
+            stmt = stmt.where(text(sql))
 
         if exclude_geofences:
             sql = geofences_to_query(exclude_geofences, 'trs_spawn')
-            query = query.filter(~text(sql))
+            stmt = stmt.where(~text(sql))
 
-        result = query.all()
+        params = viewport_params(swLat, swLng, neLat, neLng, oSwLat, oSwLng,
+                                 oNeLat, oNeLng)
+        if timestamp > 0:
+            # If timestamp is known only send last scanned spawn points.
+            params['timestamp'] = datetime.fromtimestamp(timestamp / 1000)
+        result = db.session.connection().execute(stmt, params).mappings().all()
+        if not result:
+            return []
 
-        spawnpoints = []
+        # Times are converted column-wise with NumPy instead of per row.
+        # last_scanned and last_non_scanned are in local time.
         ts = time.time()
-        utc_offset = datetime.fromtimestamp(ts) - datetime.utcfromtimestamp(ts)
-        for sp in result:
-            sp = sp._asdict()
-            if sp['last_non_scanned'] is not None:
-                sp['last_non_scanned'] = sp['last_non_scanned'] - utc_offset
+        utc_offset = np.timedelta64(
+            datetime.fromtimestamp(ts) - datetime.utcfromtimestamp(ts)
+        )
+        last_non_scanned = (
+            np.array([sp['last_non_scanned'] for sp in result],
+                     dtype='datetime64[us]')
+            - utc_offset
+        ).tolist()
+        last_scanned = (
+            np.array([sp['last_scanned'] for sp in result],
+                     dtype='datetime64[us]')
+            - utc_offset
+        ).tolist()
+
+        # end_time is the despawn time within the hour as MM:SS.
+        end_time_seconds = minsec_to_seconds(
+            [sp['end_time'] or '00:00' for sp in result]
+        )
+        now = np.datetime64(datetime.today(), 'us')
+        despawn_times = (now.astype('datetime64[h]')
+                         + end_time_seconds.astype('timedelta64[s]'))
+        despawn_times[despawn_times <= now] += ONE_HOUR
+        despawn_times = despawn_times - utc_offset
+        spawndefs = np.array([sp['spawndef'] for sp in result])
+        spawn_times = despawn_times - np.where(spawndefs == 15, ONE_HOUR,
+                                               HALF_HOUR)
+        despawn_times = despawn_times.astype('datetime64[us]').tolist()
+        spawn_times = spawn_times.astype('datetime64[us]').tolist()
+
+        spawnpoints = []
+        for i, sp in enumerate(result):
+            sp = dict(sp)
+            sp['last_non_scanned'] = last_non_scanned[i]
             if sp['end_time'] is not None:
-                if sp['last_scanned'] is not None:
-                    sp['last_scanned'] = sp['last_scanned'] - utc_offset
-                end_time_split = sp['end_time'].split(':')
-                end_time_seconds = int(end_time_split[1])
-                end_time_minutes = int(end_time_split[0])
-                despawn_time = datetime.today().replace(
-                    minute=end_time_minutes, second=end_time_seconds,
-                    microsecond=0
-                )
-                if despawn_time <= datetime.today():
-                    despawn_time += timedelta(hours=1)
-                sp['despawn_time'] = despawn_time - utc_offset
-                if sp['spawndef'] == 15:
-                    sp['spawn_time'] = sp['despawn_time'] - timedelta(hours=1)
-                else:
-                    sp['spawn_time'] = (sp['despawn_time']
-                                        - timedelta(minutes=30))
+                sp['last_scanned'] = last_scanned[i]
+                sp['despawn_time'] = despawn_times[i]
+                sp['spawn_time'] = spawn_times[i]
                 del sp['end_time']
             spawnpoints.append(sp)
 
@@ -796,56 +649,39 @@ class ScannedLocation(db.Model):
     __table_args__ = (
         Index('scannedlocation_last_modified', 'last_modified'),
         Index('scannedlocation_latitude_longitude', 'latitude', 'longitude'),
+        # Covers get_recent() (cellid is the primary key, which InnoDB
+        # stores in every secondary index), so no row lookups are needed.
+        Index('sl_cover', 'last_modified', 'latitude', 'longitude'),
     )
 
     @staticmethod
     def get_recent(swLat, swLng, neLat, neLng, oSwLat=None, oSwLng=None,
                    oNeLat=None, oNeLng=None, timestamp=0, geofences=None,
-                   exclude_geofences=None):
-        query = db.session.query(
-            ScannedLocation.cellid, ScannedLocation.latitude,
-            ScannedLocation.longitude, ScannedLocation.last_modified
-        )
-
-        if timestamp > 0:
-            # If timestamp is known only send last scanned locations.
-            t = datetime.utcfromtimestamp(timestamp / 1000)
-            query = query.filter(ScannedLocation.last_modified > t)
-        else:
-            # Only send locations scanned in last 15 minutes.
-            active_time = datetime.utcnow() - timedelta(minutes=15)
-            query = query.filter(ScannedLocation.last_modified > active_time)
-
-        if swLat and swLng and neLat and neLng:
-            query = query.filter(
-                ScannedLocation.latitude >= swLat,
-                ScannedLocation.longitude >= swLng,
-                ScannedLocation.latitude <= neLat,
-                ScannedLocation.longitude <= neLng
-            )
-
-        if oSwLat and oSwLng and oNeLat and oNeLng:
-            # Exclude scanned locations within old boundaries.
-            query = query.filter(
-                ~and_(
-                    ScannedLocation.latitude >= oSwLat,
-                    ScannedLocation.longitude >= oSwLng,
-                    ScannedLocation.latitude <= oNeLat,
-                    ScannedLocation.longitude <= oNeLng
-                )
-            )
+                   exclude_geofences=None, now=None):
+        stmt = scanned_location_stmt
 
         if geofences:
             sql = geofences_to_query(geofences, 'scannedlocation')
-            query = query.filter(text(sql))
+            stmt = stmt.where(text(sql))
 
         if exclude_geofences:
             sql = geofences_to_query(exclude_geofences, 'scannedlocation')
-            query = query.filter(~text(sql))
+            stmt = stmt.where(~text(sql))
 
-        result = query.all()
+        params = viewport_params(swLat, swLng, neLat, neLng, oSwLat, oSwLng,
+                                 oNeLat, oNeLng)
+        if timestamp > 0:
+            # If timestamp is known only send last scanned locations.
+            params['modified_since'] = datetime.utcfromtimestamp(
+                timestamp / 1000)
+        else:
+            # Only send locations scanned in last 15 minutes.
+            params['modified_since'] = ((now or datetime.utcnow())
+                                        - timedelta(minutes=15))
+
+        result = db.session.connection().execute(stmt, params).mappings()
 
-        return [loc._asdict() for loc in result]
+        return [dict(loc) for loc in result]
 
 
 class Nest(db.Model):
@@ -870,49 +706,26 @@ class Nest(db.Model):
     def get_nests(swLat, swLng, neLat, neLng, oSwLat=None, oSwLng=None,
                   oNeLat=None, oNeLng=None, timestamp=0, geofences=None,
                   exclude_geofences=None):
-        query = db.session.query(
-            Nest.nest_id, Nest.lat.label('latitude'),
-            Nest.lon.label('longitude'), Nest.pokemon_id,
-            Nest.updated.label('last_updated'), Nest.name, Nest.pokemon_count,
-            Nest.pokemon_avg
-        )
-
-        if timestamp > 0:
-            # If timestamp is known only send last updated nests.
-            query = query.filter(Nest.updated > timestamp / 1000)
-
-        if swLat and swLng and neLat and neLng:
-            query = query.filter(
-                Nest.lat >= swLat,
-                Nest.lon >= swLng,
-                Nest.lat <= neLat,
-                Nest.lon <= neLng
-            )
-
-        if oSwLat and oSwLng and oNeLat and oNeLng:
-            # Exclude scanned locations within old boundaries.
-            query = query.filter(
-                ~and_(
-                    Nest.lat >= oSwLat,
-                    Nest.lon >= oSwLng,
-                    Nest.lat <= oNeLat,
-                    Nest.lon <= oNeLng
-                )
-            )
+        stmt = nest_stmt
 
         if geofences:
             sql = geofences_to_query(geofences, 'nests', 'lat', 'lon')
-            query = query.filter(text(sql))
+            stmt = stmt.where(text(sql))
 
         if exclude_geofences:
             sql = geofences_to_query(exclude_geofences, 'nests', 'lat', 'lon')
-            query = query.filter(~text(sql))
+            stmt = stmt.where(~text(sql))
 
-        result = query.all()
+        params = viewport_params(swLat, swLng, neLat, neLng, oSwLat, oSwLng,
+                                 oNeLat, oNeLng)
+        if timestamp > 0:
+            # If timestamp is known only send last updated nests.
+            params['timestamp'] = timestamp / 1000
+        result = db.session.connection().execute(stmt, params).mappings()
 
         nests = []
         for n in result:
-            nest = n._asdict()
+            nest = dict(n)
             nest['last_updated'] *= 1000
             nests.append(nest)
 
@@ -928,6 +741,303 @@ class RmVersion(db.Model):
     val = db.Column(db.SmallInteger)
 
 
+# Tables owned by RocketMAD (the rest belong to the scanner). RmVersion is
+# created by verify_database_schema() together with its version row.
+RM_TABLES = (Nest,)
+
+
+def bounds_filter(lat_column, lng_column):
+    # Viewport filters are built once with bind parameters so every request
+    # emits the same SQL and hits the compiled statement cache. Unused bounds
+    # are bound as NULL, which turns their filter into a no-op.
+    return or_(
+        bindparam('swLat').is_(None),
+        and_(
+            lat_column >= bindparam('swLat'),
+            lng_column >= bindparam('swLng'),
+            lat_column <= bindparam('neLat'),
+            lng_column <= bindparam('neLng')
+        )
+    )
+
+
+def old_bounds_filter(lat_column, lng_column):
+    # Exclude everything within the old boundaries. Spelled out as four
+    # range disjuncts so each one can use an index.
+    return or_(
+        bindparam('oSwLat').is_(None),
+        lat_column < bindparam('oSwLat'),
+        lng_column < bindparam('oSwLng'),
+        lat_column > bindparam('oNeLat'),
+        lng_column > bindparam('oNeLng')
+    )
+
+
+def timestamp_filter(*columns):
+    # Only load rows modified since the given timestamp (if bound).
+    timestamp = bindparam('timestamp')
+    return or_(timestamp.is_(None), *(c > timestamp for c in columns))
+
+
+def viewport_params(swLat, swLng, neLat, neLng, oSwLat=None, oSwLng=None,
+                    oNeLat=None, oNeLng=None):
+    if swLat and swLng and neLat and neLng:
+        swLat, swLng = float(swLat), float(swLng)
+        neLat, neLng = float(neLat), float(neLng)
+    else:
+        swLat = swLng = neLat = neLng = None
+    if oSwLat and oSwLng and oNeLat and oNeLng:
+        oSwLat, oSwLng = float(oSwLat), float(oSwLng)
+        oNeLat, oNeLng = float(oNeLat), float(oNeLng)
+    else:
+        oSwLat = oSwLng = oNeLat = oNeLng = None
+    return {
+        'swLat': swLat, 'swLng': swLng, 'neLat': neLat, 'neLng': neLng,
+        'oSwLat': oSwLat, 'oSwLng': oSwLng, 'oNeLat': oNeLat,
+        'oNeLng': oNeLng, 'timestamp': None
+    }
+
+
+def attr_packer(attrs, keys=None):
+    # Build a function turning an object into a dict of the given attributes
+    # (stored under keys, if given). All attributes are read in one
+    # attrgetter call instead of one getattr() per column.
+    getter = attrgetter(*attrs)
+    keys = tuple(keys or attrs)
+
+    def pack(obj):
+        return dict(zip(keys, getter(obj)))
+
+    return pack
+
+
+active_pokemon_columns = (
+    Pokemon.encounter_id, Pokemon.pokemon_id, Pokemon.latitude,
+    Pokemon.longitude, Pokemon.disappear_time, Pokemon.individual_attack,
+    Pokemon.individual_defense, Pokemon.individual_stamina, Pokemon.move_1,
+    Pokemon.move_2, Pokemon.cp, Pokemon.cp_multiplier, Pokemon.weight,
+    Pokemon.height, Pokemon.gender, Pokemon.form, Pokemon.costume,
+    Pokemon.catch_prob_1, Pokemon.catch_prob_2, Pokemon.catch_prob_3,
+    Pokemon.weather_boosted_condition, Pokemon.last_modified
+)
+active_pokemon_filters = (
+    Pokemon.disappear_time > bindparam('now'),
+    timestamp_filter(Pokemon.last_modified),
+    bounds_filter(Pokemon.latitude, Pokemon.longitude),
+    old_bounds_filter(Pokemon.latitude, Pokemon.longitude)
+)
+active_pokemon_stmt = (
+    select(*active_pokemon_columns)
+    .where(*active_pokemon_filters)
+)
+# Fetch the verified despawn time with a correlated primary key lookup
+# instead of widening every row through a join on trs_spawn.
+verified_disappear_time = (
+    select(TrsSpawn.calc_endminsec)
+    .where(TrsSpawn.spawnpoint == Pokemon.spawnpoint_id)
+    .correlate(Pokemon)
+    .scalar_subquery()
+    .label('verified_disappear_time')
+)
+active_pokemon_verified_stmt = (
+    select(*active_pokemon_columns, verified_disappear_time)
+    .where(*active_pokemon_filters)
+)
+
+# Columns sent to the frontend, spelled out so columns added to the
+# scanner's schema don't leak into the response.
+gym_columns = (
+    'gym_id', 'team_id', 'guard_pokemon_id', 'slots_available', 'enabled',
+    'latitude', 'longitude', 'total_cp', 'is_in_battle', 'gender', 'form',
+    'costume', 'weather_boosted_condition', 'shiny', 'last_modified',
+    'last_scanned', 'is_ex_raid_eligible'
+)
+raid_columns = (
+    'gym_id', 'level', 'spawn', 'start', 'end', 'pokemon_id', 'cp', 'move_1',
+    'move_2', 'last_scanned', 'form', 'is_exclusive', 'gender', 'costume',
+    'evolution'
+)
+gym_filters = (
+    timestamp_filter(Gym.last_scanned),
+    bounds_filter(Gym.latitude, Gym.longitude),
+    old_bounds_filter(Gym.latitude, Gym.longitude)
+)
+# Only fetch the GymDetails columns we need instead of joined loading the
+# whole row (including the LONGTEXT description) through the relationship.
+gym_details_columns = (GymDetails.name.label('name'),
+                       GymDetails.url.label('url'))
+# Raid columns are prefixed since most of their names clash with Gym's.
+raid_select_columns = tuple(
+    getattr(Raid, c).label('raid_' + c) for c in raid_columns
+)
+gym_stmt = (
+    select(*(getattr(Gym, c) for c in gym_columns), *gym_details_columns)
+    .outerjoin(GymDetails, Gym.gym_id == GymDetails.gym_id)
+    .where(*gym_filters)
+)
+gym_raid_stmt = (
+    select(
+        *(getattr(Gym, c) for c in gym_columns), *gym_details_columns,
+        *raid_select_columns
+    )
+    .outerjoin(GymDetails, Gym.gym_id == GymDetails.gym_id)
+    .outerjoin(
+        Raid,
+        and_(Gym.gym_id == Raid.gym_id, Raid.end > bindparam('now'))
+    )
+    .where(*gym_filters)
+)
+pack_gym = attr_packer(gym_columns + ('name', 'url'))
+pack_raid = attr_packer(
+    tuple(c.name for c in raid_select_columns), raid_columns
+)
+
+pokestop_columns = (
+    'pokestop_id', 'name', 'image', 'latitude', 'longitude', 'last_updated'
+)
+quest_columns = (
+    'quest_timestamp', 'quest_task', 'quest_reward_type', 'quest_item_id',
+    'quest_item_amount', 'quest_pokemon_id', 'quest_pokemon_form_id',
+    'quest_pokemon_costume_id', 'quest_stardust'
+)
+pokestop_event_filters = (
+    and_(
+        bindparam('invasions', type_=Boolean),
+        Pokestop.incident_expiration > bindparam('now')
+    ),
+    and_(
+        bindparam('lures', type_=Boolean),
+        Pokestop.lure_expiration > bindparam('now')
+    )
+)
+# Expired (or unwanted) invasion and lure data is nulled by the database.
+invasion_active = and_(
+    bindparam('invasions', type_=Boolean),
+    Pokestop.incident_expiration >= bindparam('now')
+)
+lure_active = and_(
+    bindparam('lures', type_=Boolean),
+    Pokestop.lure_expiration >= bindparam('now')
+)
+pokestop_event_columns = (
+    case(
+        (or_(Pokestop.incident_expiration.is_(None), invasion_active),
+         Pokestop.incident_grunt_type)
+    ).label('incident_grunt_type'),
+    case(
+        (invasion_active, Pokestop.incident_expiration)
+    ).label('incident_expiration'),
+    case(
+        (or_(Pokestop.lure_expiration.is_(None), lure_active),
+         Pokestop.active_fort_modifier)
+    ).label('active_fort_modifier'),
+    case((lure_active, Pokestop.lure_expiration)).label('lure_expiration')
+)
+pokestop_filters = (
+    timestamp_filter(Pokestop.last_updated),
+    bounds_filter(Pokestop.latitude, Pokestop.longitude),
+    old_bounds_filter(Pokestop.latitude, Pokestop.longitude)
+)
+pokestop_stmt = (
+    select(
+        *(getattr(Pokestop, c) for c in pokestop_columns),
+        *pokestop_event_columns
+    )
+    .where(
+        or_(
+            bindparam('eventless_stops', type_=Boolean),
+            *pokestop_event_filters
+        ),
+        *pokestop_filters
+    )
+)
+pokestop_quest_stmt = (
+    select(
+        *(getattr(Pokestop, c) for c in pokestop_columns),
+        *pokestop_event_columns, TrsQuest.GUID,
+        *(getattr(TrsQuest, c) for c in quest_columns)
+    )
+    .outerjoin(
+        TrsQuest,
+        and_(
+            Pokestop.pokestop_id == TrsQuest.GUID,
+            TrsQuest.quest_timestamp >= bindparam('quest_reset_timestamp')
+        )
+    )
+    .where(
+        or_(
+            bindparam('eventless_stops', type_=Boolean),
+            TrsQuest.GUID.isnot(None),
+            *pokestop_event_filters
+        ),
+        *pokestop_filters
+    )
+)
+
+pack_pokestop = attr_packer(
+    pokestop_columns + tuple(c.name for c in pokestop_event_columns)
+)
+pack_quest = attr_packer(
+    quest_columns,
+    ('scanned_at', 'task', 'reward_type', 'item_id', 'item_amount',
+     'pokemon_id', 'form_id', 'costume_id', 'stardust')
+)
+
+weather_stmt = (
+    select(
+        Weather.s2_cell_id, Weather.latitude, Weather.longitude,
+        Weather.gameplay_weather, Weather.severity, Weather.world_time,
+        Weather.last_updated
+    )
+    .where(
+        timestamp_filter(Weather.last_updated),
+        bounds_filter(Weather.latitude, Weather.longitude),
+        old_bounds_filter(Weather.latitude, Weather.longitude)
+    )
+)
+
+spawnpoint_stmt = (
+    select(
+        TrsSpawn.latitude, TrsSpawn.longitude,
+        TrsSpawn.spawnpoint.label('spawnpoint_id'), TrsSpawn.spawndef,
+        TrsSpawn.first_detection, TrsSpawn.last_non_scanned,
+        TrsSpawn.last_scanned, TrsSpawn.calc_endminsec.label('end_time')
+    )
+    .where(
+        timestamp_filter(TrsSpawn.last_scanned, TrsSpawn.last_non_scanned),
+        bounds_filter(TrsSpawn.latitude, TrsSpawn.longitude),
+        old_bounds_filter(TrsSpawn.latitude, TrsSpawn.longitude)
+    )
+)
+
+scanned_location_stmt = (
+    select(
+        ScannedLocation.cellid, ScannedLocation.latitude,
+        ScannedLocation.longitude, ScannedLocation.last_modified
+    )
+    .where(
+        ScannedLocation.last_modified > bindparam('modified_since'),
+        bounds_filter(ScannedLocation.latitude, ScannedLocation.longitude),
+        old_bounds_filter(ScannedLocation.latitude,
+                          ScannedLocation.longitude)
+    )
+)
+
+nest_stmt = (
+    select(
+        Nest.nest_id, Nest.lat.label('latitude'),
+        Nest.lon.label('longitude'), Nest.pokemon_id,
+        Nest.updated.label('last_updated'), Nest.name, Nest.pokemon_count,
+        Nest.pokemon_avg
+    )
+    .where(
+        timestamp_filter(Nest.updated),
+        bounds_filter(Nest.lat, Nest.lon),
+        old_bounds_filter(Nest.lat, Nest.lon)
+    )
+)
+
+
 def geofences_to_query(geofences, table_name, lat_column_name='latitude',
                        lng_column_name='longitude'):
     query = ''
@@ -946,21 +1056,19 @@ def geofences_to_query(geofences, table_name, lat_column_name='latitude',
     return f'({query})'
 
 
-def orm_to_dict(orm_result):
-    if isinstance(orm_result, list):
-        result = []
-        for r in orm_result:
-            d = dict(r.__dict__)
-            del d['_sa_instance_state']
-            result.append(d)
-    else:
-        result = dict(orm_result.__dict__)
-        del result['_sa_instance_state']
-    return result
+# Tables known to exist, so repeated schema checks (the migration checks
+# most tables several times) skip the information_schema lookup.
+known_tables = set()
 
 
 def table_exists(table_model):
-    return db.engine.has_table(table_model.__tablename__)
+    table_name = table_model.__tablename__
+    if table_name in known_tables:
+        return True
+    if db.engine.has_table(table_name):
+        known_tables.add(table_name)
+        return True
+    return False
 
 
 def create_table(table_model):
@@ -969,8 +1077,7 @@ def create_table(table_model):
 
 
 def create_rm_tables():
-    tables = [Nest]
-    for table in tables:
+    for table in RM_TABLES:
         if not table_exists(table):
             log.info('Creating table: %s', table.__tablename__)
             table.__table__.create(db.engine)
@@ -983,26 +1090,60 @@ def drop_table(table_model=None, table_name=None):
     if table_name:
         query = 'DROP TABLE IF EXISTS {}'.format(table_name)
         db.session.execute(text(query))
+        known_tables.discard(table_name)
     elif table_model and table_exists(table_model):
         table_model.__table__.drop(db.engine)
+        known_tables.discard(table_model.__tablename__)
 
 
 def drop_rm_tables():
-    tables = [Nest, RmVersion]
-    for table in tables:
+    for table in RM_TABLES + (RmVersion,):
         if table_exists(table):
             log.info('Dropping table: %s', table.__tablename__)
             table.__table__.drop(db.engine)
+            known_tables.discard(table.__tablename__)
         else:
             log.debug('Skipping table %s, it doesn\'t exist.',
                       table.__tablename__)
 
 
-def add_column(table_name, column):
-    column_name = column.compile(dialect=db.engine.dialect)
-    column_type = column.type.compile(db.engine.dialect)
+def add_column(table_model, column):
+    # Returns False if the table doesn't exist (yet) and nothing was done.
+    if not table_exists(table_model):
+        log.warning('Table %s doesn\'t exist, not adding column %s.',
+                    table_model.__tablename__, column.name)
+        return False
+    table_name = table_model.__tablename__
+    columns = inspect(db.engine).get_columns(table_name)
+    if any(c['name'] == column.name for c in columns):
+        return True
+    # Compiling the column itself would render it qualified (table.column),
+    # which ADD COLUMN doesn't accept.
+    dialect = db.engine.dialect
+    column_name = dialect.identifier_preparer.format_column(column)
+    column_type = column.type.compile(dialect)
+    log.info('Adding column %s to table %s.', column.name, table_name)
     query = f'ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}'
     db.session.execute(text(query))
+    db.session.commit()
+    return True
+
+
+def add_index(table_model, index_name):
+    # Returns False if the table doesn't exist (yet) and nothing was done.
+    if not table_exists(table_model):
+        log.warning('Table %s doesn\'t exist, not creating index %s.',
+                    table_model.__tablename__, index_name)
+        return False
+    table_name = table_model.__tablename__
+    indexes = inspect(db.engine).get_indexes(table_name)
+    if any(index['name'] == index_name for index in indexes):
+        return True
+    index = next(index for index in table_model.__table__.indexes
+                 if index.name == index_name)
+    log.info('Creating index %s on table %s.', index_name, table_name)
+    index.create(db.engine)
+    return True
 
 
 def verify_database_schema():
@@ -1011,86 +1152,162 @@ def verify_database_schema():
         db_ver = RmVersion(key='schema_version', val=0)
         db.session.add(db_ver)
         db.session.commit()
-        database_migrate(0)
+        database_migrate(0, db_ver)
     else:
-        db_ver = RmVersion.query.get('schema_version').val
+        db_ver = db.session.get(RmVersion, 'schema_version')
 
-        if db_ver < db_schema_version:
-            if not database_migrate(db_ver):
+        if db_ver.val < db_schema_version:
+            if not database_migrate(db_ver.val, db_ver):
                 log.error('Error migrating database.')
                 sys.exit(1)
-        elif db_ver > db_schema_version:
+        elif db_ver.val > db_schema_version:
             log.error('Your database version (%i) appears to be newer than '
-                      'the code supports (%i).', db_ver, db_schema_version)
+                      'the code supports (%i).', db_ver.val,
+                      db_schema_version)
             log.error('Please upgrade your code base or drop all RM tables in '
                       'your database.')
             sys.exit(1)
 
 
-def database_migrate(old_ver):
+def database_migrate(old_ver, db_ver=None):
     log.info('Detected database version %i, updating to %i...',
              old_ver, db_schema_version)
 
-    # Update database schema version.
-    db_ver = RmVersion.query.get('schema_version')
-    db_ver.val = db_schema_version
-    db.session.commit()
-
-    # Perform migrations here.
+    # Perform migrations here. Steps are safe to repeat, and complete stays
+    # True only if none of them had to be skipped.
+    complete = True
     if old_ver < 1:
         drop_table(table_name='rmversions')
 
+    if old_ver < 2:
+        complete &= add_index(Pokemon,
+                              'pokemon_disappear_time_latitude_longitude')
+
+    if old_ver < 3:
+        complete &= add_index(ScannedLocation, 'sl_cover')
+
+    if old_ver < 4:
+        complete &= add_index(TrsSpawn,
+                              'trs_spawn_last_scanned_last_non_scanned')
+
+    if not complete:
+        # Keep the old version so the skipped steps are retried on the next
+        # start, e.g. once MAD has created its tables.
+        log.warning('Schema upgrade incomplete, it will be retried on the '
+                    'next start.')
+        return True
+
+    # Update database schema version only once every step succeeded, so a
+    # failed step (which raises) is retried on the next start.
+    if db_ver is None:
+        db_ver = db.session.get(RmVersion, 'schema_version')
+    db_ver.val = db_schema_version
+    db.session.commit()
+
     # Always log that we're done.
     log.info('Schema upgrade complete.')
     return True
 
 
 def clean_db_loop(app):
-    while True:
+    tasks = []
+    # Remove old pokemon spawns.
+    if args.db_cleanup_pokemon > 0:
+        tasks.append((db_clean_pokemons, (args.db_cleanup_pokemon,)))
+    # Remove old gym data.
+    if args.db_cleanup_gym > 0:
+        tasks.append((db_clean_gyms, (args.db_cleanup_gym,)))
+    # Remove old pokestop data.
+    if args.db_cleanup_pokestop:
+        tasks.append((db_clean_pokestops, ()))
+    # Remove old pokestop and gym locations.
+    if args.db_cleanup_forts > 0:
+        tasks.append((db_clean_forts, (args.db_cleanup_forts,)))
+    # Remove old and extinct spawnpoint data.
+    if args.db_cleanup_spawnpoint > 0:
+        tasks.append((db_clean_spawnpoints, (args.db_cleanup_spawnpoint,)))
+    # Clean weather... only changes at full hours anyway...
+    tasks.append((db_clean_weather, ()))
+
+    scheduler = sched.scheduler(default_timer, time.sleep)
+
+    def run_task(priority, task, task_args, start):
+        # Each task runs in its own app context, so one failing doesn't
+        # stop or delay the others.
         try:
             with app.app_context():
-                # Remove old pokemon spawns.
-                if args.db_cleanup_pokemon > 0:
-                    db_clean_pokemons(args.db_cleanup_pokemon)
-
-                # Remove old gym data.
-                if args.db_cleanup_gym > 0:
-                    db_clean_gyms(args.db_cleanup_gym)
+                task(*task_args)
+        except Exception as e:
+            log.exception('Database cleanup %s failed: %s.', task.__name__,
+                          e)
 
-                # Remove old pokestop data.
-                if args.db_cleanup_pokestop:
-                    db_clean_pokestops()
+        # Tasks starting together run in priority order, so the last one
+        # finishing ends the cleanup cycle.
+        if priority == len(tasks) - 1:
+            log.info('Database cleanup completed.')
 
-                # Remove old pokestop and gym locations.
-                if args.db_cleanup_forts > 0:
-                    db_clean_forts(args.db_cleanup_forts)
+        # Schedule from the planned start rather than the end of this run so
+        # the interval doesn't drift, skipping runs a slow task overran.
+        interval = args.db_cleanup_interval
+        start += interval
+        now = default_timer()
+        if start < now:
+            if interval > 0:
+                missed = (now - start) // interval + 1
+                start += missed * interval
+            else:
+                # An interval of 0 runs the cleanups back to back.
+                start = now
+        scheduler.enterabs(start, priority, run_task,
+                           (priority, task, task_args, start))
+
+    start = default_timer()
+    for priority, (task, task_args) in enumerate(tasks):
+        scheduler.enterabs(start, priority, run_task,
+                           (priority, task, task_args, start))
+    scheduler.run()
+
+
+def execute_in_batches(stmt, params=None):
+    # Run a statement limited to the batch size until it affects fewer rows,
+    # committing each batch so every transaction only locks a bounded number
+    # of rows and doesn't block the scanner writing to the table.
+    rows = 0
+    while True:
+        r = db.session.execute(stmt, params).rowcount
+        db.session.commit()
+        rows += r
+        if r < args.db_cleanup_batch_size:
+            return rows
 
-                # Remove old and extinct spawnpoint data.
-                if args.db_cleanup_spawnpoint > 0:
-                    db_clean_spawnpoints(args.db_cleanup_spawnpoint)
 
-                # Clean weather... only changes at full hours anyway...
-                Weather.query.filter(
-                    Weather.last_updated
-                    < datetime.utcnow() - timedelta(hours=1)
-                ).delete()
-                db.session.commit()
+def delete_in_batches(query, params):
+    params = dict(params, limit=args.db_cleanup_batch_size)
+    return execute_in_batches(text(query + ' LIMIT :limit'), params)
 
-            log.info('Database cleanup completed.')
 
-            time.sleep(args.db_cleanup_interval)
-        except Exception as e:
-            log.exception('Database cleanup failed: %s.', e)
+def update_in_batches(stmt):
+    # Nothing is loaded in the session, so skip synchronizing it with the
+    # updated rows.
+    stmt = (
+        stmt
+        .with_dialect_options(mysql_limit=args.db_cleanup_batch_size)
+        .execution_options(synchronize_session=False)
+    )
+    return execute_in_batches(stmt)
 
 
 def db_clean_pokemons(age_hours):
     log.debug('Beginning cleanup of old pokemon spawns.')
     start_timer = default_timer()
 
-    pokemon_timeout = datetime.utcnow() - timedelta(hours=age_hours)
-    r = Pokemon.query.filter(Pokemon.disappear_time < pokemon_timeout).delete()
-    db.session.commit()
-    log.debug('Deleted %d old Pokemon entries.', r)
+    rows = delete_in_batches(
+        'DELETE FROM pokemon '
+        'WHERE disappear_time < UTC_TIMESTAMP() - INTERVAL :hours HOUR '
+        'ORDER BY disappear_time',
+        {'hours': age_hours}
+    )
+    log.debug('Deleted %d old Pokemon entries.', rows)
 
     time_diff = default_timer() - start_timer
     log.debug('Completed cleanup of old pokemon spawns in %.6f seconds.',
@@ -1101,20 +1318,20 @@ def db_clean_gyms(age_hours):
     log.debug('Beginning cleanup of old gym data.')
     start_timer = default_timer()
 
-    gym_info_timeout = datetime.utcnow() - timedelta(hours=age_hours)
-
     # Remove old GymDetails entries.
-    rows = (
-        GymDetails.query
-        .filter(GymDetails.last_scanned < gym_info_timeout)
-        .delete()
+    rows = delete_in_batches(
+        'DELETE FROM gymdetails '
+        'WHERE last_scanned < UTC_TIMESTAMP() - INTERVAL :hours HOUR',
+        {'hours': age_hours}
     )
-    db.session.commit()
     log.debug('Deleted %d old GymDetails entries.', rows)
 
     # Remove old Raid entries.
-    rows = Raid.query.filter(Raid.end < gym_info_timeout).delete()
-    db.session.commit()
+    rows = delete_in_batches(
+        'DELETE FROM raid '
+        'WHERE `end` < UTC_TIMESTAMP() - INTERVAL :hours HOUR',
+        {'hours': age_hours}
+    )
     log.debug('Deleted %d old Raid entries.', rows)
 
     time_diff = default_timer() - start_timer
@@ -1125,19 +1342,21 @@ def db_clean_pokestops():
     log.debug('Beginning cleanup of pokestops.')
     start_timer = default_timer()
 
-    now = datetime.utcnow()
-
     # Remove expired lure data.
-    Pokestop.query.filter(Pokestop.lure_expiration < now).update(
-        dict(lure_expiration=None, active_fort_modifier=None)
+    rows = update_in_batches(
+        update(Pokestop)
+        .where(Pokestop.lure_expiration < func.utc_timestamp())
+        .values(lure_expiration=None, active_fort_modifier=None)
     )
-    db.session.commit()
+    log.debug('Removed %d expired lures.', rows)
 
     # Remove expired invasion data.
-    Pokestop.query.filter(Pokestop.incident_expiration < now).update(
-        dict(incident_expiration=None, incident_grunt_type=None)
+    rows = update_in_batches(
+        update(Pokestop)
+        .where(Pokestop.incident_expiration < func.utc_timestamp())
+        .values(incident_expiration=None, incident_grunt_type=None)
     )
-    db.session.commit()
+    log.debug('Removed %d expired invasions.', rows)
 
     # Remove old TrsQuest entries.
     hours = int(args.quest_reset_time.split(':')[0])
@@ -1146,10 +1365,10 @@ def db_clean_pokestops():
         hour=hours, minute=minutes, second=0, microsecond=0
     )
     reset_timestamp = datetime.timestamp(reset_time)
-    rows = TrsQuest.query.filter(
-        TrsQuest.quest_timestamp < reset_timestamp
-    ).delete()
-    db.session.commit()
+    rows = delete_in_batches(
+        'DELETE FROM trs_quest WHERE quest_timestamp < :timeout',
+        {'timeout': reset_timestamp}
+    )
     log.debug('Deleted %d old TrsQuest entries.', rows)
 
     time_diff = default_timer() - start_timer
@@ -1160,16 +1379,20 @@ def db_clean_forts(age_hours):
     log.debug('Beginning cleanup of old forts.')
     start_timer = default_timer()
 
-    fort_timeout = datetime.utcnow() - timedelta(hours=age_hours)
-
     # Remove old Gym entries.
-    rows = Gym.query.filter(Gym.last_scanned < fort_timeout).delete()
-    db.session.commit()
+    rows = delete_in_batches(
+        'DELETE FROM gym '
+        'WHERE last_scanned < UTC_TIMESTAMP() - INTERVAL :hours HOUR',
+        {'hours': age_hours}
+    )
     log.debug('Deleted %d old Gym entries.', rows)
 
     # Remove old Pokestop entries.
-    rows = Pokestop.query.filter(Pokestop.last_updated < fort_timeout).delete()
-    db.session.commit()
+    rows = delete_in_batches(
+        'DELETE FROM pokestop '
+        'WHERE last_updated < UTC_TIMESTAMP() - INTERVAL :hours HOUR',
+        {'hours': age_hours}
+    )
     log.debug('Deleted %d old Pokestop entries.', rows)
 
     time_diff = default_timer() - start_timer
@@ -1184,15 +1407,30 @@ def db_clean_spawnpoints(age_hours):
     # last_scanned and last_non_scanned are in local time.
     spawnpoint_timeout = datetime.now() - timedelta(hours=age_hours)
 
-    rows = TrsSpawn.query.filter(
-        (TrsSpawn.last_scanned < spawnpoint_timeout)
-        | TrsSpawn.last_scanned.is_(None),
-        (TrsSpawn.last_non_scanned < spawnpoint_timeout)
-        | TrsSpawn.last_non_scanned.is_(None)
-    ).delete()
-    db.session.commit()
+    rows = delete_in_batches(
+        'DELETE FROM trs_spawn '
+        'WHERE (last_scanned < :timeout OR last_scanned IS NULL) '
+        'AND (last_non_scanned < :timeout OR last_non_scanned IS NULL)',
+        {'timeout': spawnpoint_timeout}
+    )
     log.debug('Deleted %d old TrsSpawn entries.', rows)
 
     time_diff = default_timer() - start_timer
     log.debug('Completed cleanup of old spawnpoint data in %.6f seconds.',
               time_diff)
+
+
+def db_clean_weather():
+    log.debug('Beginning cleanup of old weather data.')
+    start_timer = default_timer()
+
+    rows = delete_in_batches(
+        'DELETE FROM weather '
+        'WHERE last_updated < UTC_TIMESTAMP() - INTERVAL 1 HOUR',
+        {}
+    )
+    log.debug('Deleted %d old Weather entries.', rows)
+
+    time_diff = default_timer() - start_timer
+    log.debug('Completed cleanup of old weather data in %.6f seconds.',
+              time_diff)
@@ -9,6 +9,7 @@ import json
 import logging
 import math
 import multiprocessing
+import numpy as np
 import os
 import pickle
 import psutil
@@ -393,6 +394,11 @@ def get_args(access_config=None):
                              'after last valid scan. '
                              'Default: 0, 0 to disable.'),
                        type=int, default=0)
+    group.add_argument('-DCb', '--db-cleanup-batch-size',
+                       help=('Maximum number of rows deleted or updated per '
+                             'statement during database cleanup. '
+                             'Default: 5000.'),
+                       type=int, default=5000)
 
     parser.add_argument('--ssl-certificate',
                         help='Path to SSL certificate file.')
@@ -728,6 +734,12 @@ def get_args(access_config=None):
     else:
         args.db_cleanup = False
 
+    if args.db_cleanup_batch_size < 1:
+        parser.print_usage()
+        print(sys.argv[0] + ': error: -DCb/--db-cleanup-batch-size must be '
+              'at least 1.')
+        sys.exit(1)
+
     if args.basic_auth or args.discord_auth or args.telegram_auth:
         if args.server_uri is None:
             parser.print_usage()
@@ -787,6 +799,28 @@ def clock_between(start, test, end):
             or (not (end <= test <= start) and start > end))
 
 
+# Converts a list of 'MM:SS' strings to a NumPy array of seconds.
+def minsec_to_seconds(values):
+    # Parse well-formed values straight from their ASCII bytes: one (N, 5)
+    # uint8 array and a few integer ops instead of split() + int() per value.
+    if all(len(value) == 5 for value in values):
+        digits = np.frombuffer(''.join(values).encode('ascii', 'replace'),
+                               dtype=np.uint8).reshape(-1, 5)
+        numbers = digits[:, [0, 1, 3, 4]]
+        if ((digits[:, 2] == ord(':')).all()
+                and ((numbers >= ord('0')) & (numbers <= ord('9'))).all()):
+            numbers = numbers.astype(np.int64) - ord('0')
+            return (numbers[:, 0] * 600 + numbers[:, 1] * 60
+                    + numbers[:, 2] * 10 + numbers[:, 3])
+
+    # Anything else (e.g. '5:30') is parsed one value at a time.
+    seconds = []
+    for value in values:
+        minutes, secs = value.split(':')
+        seconds.append(int(minutes) * 60 + int(secs))
+    return np.array(seconds, dtype=np.int64)
+
+
 def extract_coordinates(location):
     # Use lat/lng directly if matches such a pattern.
     prog = re.compile(r"^(\-?\d+\.\d+),?\s?(\-?\d+\.\d+)$")
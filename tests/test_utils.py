@@ -26,3 +26,15 @@ class UtilsTest(unittest.TestCase):
 
         # Unknown ID raises KeyError
         self.assertRaises(KeyError, utils.get_pokemon_name, 12367)
+
+    def test_minsec_to_seconds(self):
+        self.assertEqual([0, 330, 3599],
+                         utils.minsec_to_seconds(
+                             ['00:00', '05:30', '59:59']).tolist())
+        self.assertEqual([330, 3599, 60],
+                         utils.minsec_to_seconds(
+                             ['5:30', '59:59', '01:00']).tolist())
+        self.assertEqual([], utils.minsec_to_seconds([]).tolist())
+
+        # Malformed values raise ValueError
+        self.assertRaises(ValueError, utils.minsec_to_seconds, ['05-30'])